@@ -1,12 +1,196 @@
 import os
-import uuid
-import json
-import requests
-from fastapi import FastAPI, Form, HTTPException
-from fastapi.responses import JSONResponse
+import secrets
+import sys
+import asyncio
+import collections
+import gzip
+import logging
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Annotated
+
+import httpx
+import orjson
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import ORJSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
+from pydantic import BaseModel, Field, HttpUrl
+
+log = logging.getLogger("video-builder-web")
+
+# ====================================================
+# CONFIG — Cloudflare Queues
+# ====================================================
+CF_API_BASE = "https://api.cloudflare.com"
+
+RETRY_BACKOFF = 0.25
+# Cloudflare statuses worth retrying; anything else is a permanent failure
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Cloudflare accepts at most 100 messages per messages/batch call
+MAX_BULK = 100
+
+# /video-url success body. job_id is hex and dropped in as-is; the two
+# date-derived fields are filled with orjson-encoded (quoted, escaped) strings.
+QUEUED_TEMPLATE = (
+    b'{"status":"queued","job_id":"%s","video_file":%s,'
+    b'"message":"Job queued successfully. Worker will process it.",'
+    b'"estimated_location":%s}'
+)
+
+
+@dataclass(frozen=True, slots=True)
+class Config:
+    """Settings read once from the environment at startup."""
+    account_id: str
+    queue_id: str
+    queue_name: str
+    api_token: str = field(repr=False)  # bearer token; keep it out of logs
+    queue_path: str
+    queue_url: str
+    # Batching — jobs are coalesced into one messages/batch call
+    max_batch: int = 50
+    max_wait_ms: float = 50
+    max_pending: int = 10000
+    max_retries: int = 5
+    # gzip batch bodies on the way to Cloudflare; off unless the endpoint accepts it
+    gzip_requests: bool = False
+
 
-app = FastAPI(title="Video Builder Web API")
+def load_config() -> Config:
+    """
+    Read and validate the settings from the environment.
+
+    Called from the lifespan startup so importing this module has no
+    side effects and needs no credentials.
+    """
+    account_id = os.getenv("CF_ACCOUNT_ID")
+    queue_id = os.getenv("CF_QUEUE_ID")
+    api_token = os.getenv("CF_API_TOKEN")
+
+    if not all([account_id, queue_id, api_token]):
+        raise RuntimeError("Missing CF_ACCOUNT_ID, CF_QUEUE_ID, or CF_API_TOKEN")
+
+    # Built and interned once; requests resolve it against the client's base_url
+    queue_path = sys.intern(
+        f"/client/v4/accounts/"
+        f"{account_id}/queues/{queue_id}/messages/batch"
+    )
+
+    max_batch = int(os.getenv("QUEUE_MAX_BATCH", "50"))
+    max_wait_ms = float(os.getenv("QUEUE_MAX_WAIT_MS", "50"))
+    max_pending = int(os.getenv("QUEUE_MAX_PENDING", "10000"))
+
+    # Cloudflare rejects bigger batches outright, and 0 would spin on empty POSTs
+    if not 1 <= max_batch <= MAX_BULK:
+        raise RuntimeError(f"QUEUE_MAX_BATCH must be between 1 and {MAX_BULK}, got {max_batch}")
+    if max_wait_ms <= 0:
+        raise RuntimeError(f"QUEUE_MAX_WAIT_MS must be positive, got {max_wait_ms}")
+    if max_pending <= 0:
+        raise RuntimeError(f"QUEUE_MAX_PENDING must be positive, got {max_pending}")
+
+    return Config(
+        account_id=account_id,
+        queue_id=queue_id,
+        queue_name=os.getenv("CF_QUEUE_NAME", "video-jobs"),
+        api_token=api_token,
+        queue_path=queue_path,
+        queue_url=CF_API_BASE + queue_path,
+        max_batch=max_batch,
+        max_wait_ms=max_wait_ms,
+        max_pending=max_pending,
+        max_retries=int(os.getenv("QUEUE_MAX_RETRIES", "5")),
+        gzip_requests=os.getenv("QUEUE_GZIP_REQUESTS", "0") == "1",
+    )
+
+
+# ====================================================
+# APP — Shared Cloudflare client lives for the app lifetime
+# ====================================================
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Load config, open one keep-alive client to Cloudflare and run the drain loop."""
+    # Set up here rather than at import so `import main` stays side-effect free;
+    # basicConfig is a no-op if the host already configured the root logger.
+    logging.basicConfig(
+        level=os.getenv("LOG_LEVEL", "INFO").upper(),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    # httpx logs every request at INFO; keep that out of production logs
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    config = app.state.config = load_config()
+    log.info(
+        "config loaded account=%s queue_id=%s queue_name=%s "
+        "batch=%d wait_ms=%s max_pending=%d",
+        config.account_id, config.queue_id, config.queue_name,
+        config.max_batch, config.max_wait_ms, config.max_pending,
+    )
+    # The liveness payload never changes, so encode it once
+    app.state.health_body = orjson.dumps({
+        "status": "ok",
+        "service": "video-builder-web",
+        "version": "2.0",
+        "queue": config.queue_name,
+    })
+
+    app.state.cf = httpx.AsyncClient(
+        base_url=CF_API_BASE,
+        headers={
+            "Authorization": f"Bearer {config.api_token}",
+            "Content-Type": "application/json",
+        },
+        timeout=15.0,
+        # HTTP/2 multiplexes concurrent batch POSTs over one TLS connection.
+        # Pool limits must live on the transport; the client ignores them once
+        # a custom transport is passed.
+        transport=httpx.AsyncHTTPTransport(
+            retries=3,
+            http2=True,
+            limits=httpx.Limits(
+                max_keepalive_connections=32,
+                max_connections=64,
+                keepalive_expiry=60,
+            ),
+        ),
+    )
+    app.state.pending = collections.deque()
+    app.state.wake = asyncio.Event()
+    # (jobs, idempotency_key) the drainer has popped but not finished sending
+    app.state.inflight = None
+    drainer = asyncio.create_task(drain_loop(app.state))
+    try:
+        yield
+    finally:
+        drainer.cancel()
+        try:
+            await drainer
+        except asyncio.CancelledError:
+            pass
+        # Best-effort flush of anything still waiting so deploys don't drop jobs.
+        # An interrupted in-flight batch is re-sent as-is; if the first POST did
+        # land, the worker dedups on each message's job_id (the reused
+        # Idempotency-Key header is only advisory).
+        batches = []
+        if app.state.inflight is not None:
+            batches.append(app.state.inflight)
+            app.state.inflight = None
+        leftover = list(app.state.pending)
+        app.state.pending.clear()
+        for i in range(0, len(leftover), config.max_batch):
+            batches.append((leftover[i:i + config.max_batch], secrets.token_hex(16)))
+        for batch, batch_id in batches:
+            try:
+                await enqueue_jobs(app.state.cf, config, batch, batch_id)
+            except HTTPException as e:
+                log.error("lost %d job(s) on shutdown: %s", len(batch), e.detail)
+        await app.state.cf.aclose()
+
+
+app = FastAPI(
+    title="Video Builder Web API",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 # Enable CORS for n8n integration
 app.add_middleware(
@@ -17,153 +201,250 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# ====================================================
-# CONFIG — Cloudflare Queues
-# ====================================================
-CF_ACCOUNT_ID = os.getenv("CF_ACCOUNT_ID")
-CF_QUEUE_ID = os.getenv("CF_QUEUE_ID")
-CF_QUEUE_NAME = os.getenv("CF_QUEUE_NAME", "video-jobs")
-CF_API_TOKEN = os.getenv("CF_API_TOKEN")
-
-required = [CF_ACCOUNT_ID, CF_QUEUE_ID, CF_API_TOKEN]
-if not all(required):
-    raise RuntimeError("Missing CF_ACCOUNT_ID, CF_QUEUE_ID, or CF_API_TOKEN")
-
-# CHANGED: Use /messages/push endpoint
-QUEUE_URL = (
-    f"https://api.cloudflare.com/client/v4/accounts/"
-    f"{CF_ACCOUNT_ID}/queues/{CF_QUEUE_ID}/messages/batch"
-)
-
-HEADERS = {
-    "Authorization": f"Bearer {CF_API_TOKEN}",
-    "Content-Type": "application/json",
-}
-
-print(f"✅ Configuration loaded:")
-print(f"   Account ID: {CF_ACCOUNT_ID}")
-print(f"   Queue ID: {CF_QUEUE_ID}")
-print(f"   Queue Name: {CF_QUEUE_NAME}")
-print(f"   Queue URL: {QUEUE_URL}")
-
 
 # ====================================================
-# FUNCTION — Push a job into Cloudflare Queue
+# FUNCTION — Push jobs into Cloudflare Queue
 # ====================================================
-def enqueue_job(job: dict):
-    """Send a job to Cloudflare Queue for processing."""
-    payload = {
-        "messages": [{"body": job}]
-    }
+async def enqueue_jobs(client: httpx.AsyncClient, config: Config, jobs: list, idempotency_key: str | None = None):
+    """
+    Send a batch of jobs to Cloudflare Queue in a single request.
 
-    print(f"\n📤 Sending job to queue:")
-    print(f"   Job ID: {job.get('job_id')}")
-    print(f"   Audio URL: {job.get('audio_url')}")
-    print(f"   Image URL: {job.get('image_url')}")
+    Any 2xx counts as success without parsing the response body.
+    Transient failures (network errors and RETRY_STATUSES) raise a 503 so
+    callers can retry; anything else raises a 502.
+    """
+    body = orjson.dumps({"messages": [{"body": job} for job in jobs]})
+    headers = {"Idempotency-Key": idempotency_key} if idempotency_key else {}
+    if config.gzip_requests:
+        body = gzip.compress(body, compresslevel=1)
+        headers["Content-Encoding"] = "gzip"
+
+    if log.isEnabledFor(logging.DEBUG):
+        for job in jobs:
+            log.debug(
+                "sending job id=%s audio=%s image=%s",
+                job.get("job_id"), job.get("audio_url"), job.get("image_url"),
+            )
 
     try:
-        resp = requests.post(
-            QUEUE_URL,
-            headers=HEADERS,
-            json=payload,
-            timeout=15
+        resp = await client.post(
+            config.queue_path,
+            content=body,
+            headers=headers,
         )
 
-        print(f"   Response Status: {resp.status_code}")
+        log.debug("cloudflare responded status=%s via %s", resp.status_code, resp.http_version)
 
         if resp.status_code >= 300:
-            print(f"❌ Cloudflare Queue error: {resp.text}")
+            log.error("cloudflare queue error status=%s body=%s", resp.status_code, resp.text)
             raise HTTPException(
-                status_code=502,
+                status_code=503 if resp.status_code in RETRY_STATUSES else 502,
                 detail=f"Cloudflare Queue error: status={resp.status_code}, body={resp.text}"
             )
 
-        data = resp.json()
-        if not data.get("success", False):
-            print(f"❌ Cloudflare Queue returned error: {json.dumps(data)}")
-            raise HTTPException(
-                status_code=502,
-                detail=f"Cloudflare Queue returned error: {json.dumps(data)}"
-            )
-
-        print(f"✅ Job queued successfully")
-        return data
+        # A 2xx from Cloudflare means the batch was accepted; the body isn't needed
+        log.info("queued %d job(s)", len(jobs))
 
-    except requests.RequestException as e:
-        print(f"❌ Request failed: {e}")
+    except httpx.HTTPError as e:
+        log.error("request to cloudflare failed: %s", e)
         raise HTTPException(
-            status_code=502,
+            status_code=503,
             detail=f"Failed to connect to Cloudflare Queue: {str(e)}"
         )
 
 
+async def enqueue_with_retry(client: httpx.AsyncClient, config: Config, jobs: list, batch_id: str):
+    """
+    Send a batch, retrying transient failures with exponential backoff.
+
+    Retries can enqueue a batch twice; the worker dedups on the job_id in
+    each message body. Every attempt also carries the same Idempotency-Key
+    header, but that is only advisory: Cloudflare Queues does not document
+    it and the worker never sees it.
+
+    Raises the last HTTPException once the error is permanent or retries
+    are exhausted.
+    """
+    max_retries = config.max_retries
+    for attempt in range(max_retries + 1):
+        try:
+            return await enqueue_jobs(client, config, jobs, batch_id)
+        except HTTPException as e:
+            if e.status_code != 503 or attempt == max_retries:
+                raise
+            delay = RETRY_BACKOFF * (2 ** attempt)
+            log.warning("retrying batch in %.1fs (attempt %d/%d)", delay, attempt + 1, max_retries)
+            await asyncio.sleep(delay)
+
+
+async def flush_with_retry(state, jobs: list, batch_id: str):
+    """Send a drained batch with retries; callers were already answered, so failures are logged."""
+    try:
+        await enqueue_with_retry(state.cf, state.config, jobs, batch_id)
+    except HTTPException as e:
+        log.error("dropping %d job(s): %s", len(jobs), e.detail)
+async def drain_loop(state):
+    """
+    Drain state.pending and flush it to Cloudflare in batches.
+
+    Producers append to the deque and set state.wake when the first job
+    arrives or a full batch is ready. A batch is sent once max_batch jobs
+    are pending or max_wait_ms has elapsed since the first one arrived.
+    Callers have already been answered, so failures are retried here and
+    logged.
+    """
+    loop = asyncio.get_running_loop()
+    max_batch = state.config.max_batch
+    max_wait = state.config.max_wait_ms / 1000
+    pending, wake = state.pending, state.wake
+
+    while True:
+        # A job picked up by the previous flush can leave the event set with
+        # nothing pending; only start the window once a job is actually here.
+        while not pending:
+            wake.clear()
+            await wake.wait()
+        wake.clear()
+
+        if len(pending) < max_batch:
+            # Give the batch max_wait_ms to fill; a full batch wakes us early
+            timer = loop.call_later(max_wait, wake.set)
+            try:
+                await wake.wait()
+            finally:
+                timer.cancel()
+            wake.clear()
+
+        while pending:
+            batch = [pending.popleft() for _ in range(min(max_batch, len(pending)))]
+            # Kept on state until done so a shutdown mid-send can still reach it
+            state.inflight = (batch, secrets.token_hex(16))
+            try:
+                await flush_with_retry(state, *state.inflight)
+            except Exception:
+                # Anything unexpected must not kill the drainer, or /video-url
+                # would keep answering "queued" for jobs nobody sends
+                log.exception("unexpected error flushing %d job(s); dropping them", len(batch))
+            state.inflight = None
+
+
+# ====================================================
+# MODELS — Request bodies
+# ====================================================
+class VideoJobIn(BaseModel):
+    """A video creation job as posted by n8n."""
+    audio_url: HttpUrl  # Full URL to the MP3 audio file in R2
+    image_url: HttpUrl  # Full URL to the image file in R2
+    date: str           # Date string for the filename (e.g., "2025-01-24")
+
+
+def build_job(body: VideoJobIn) -> dict:
+    """Turn a submitted job into the message body the worker expects."""
+    return {
+        "job_id": secrets.token_hex(16),
+        "audio_url": str(body.audio_url),
+        "image_url": str(body.image_url),
+        "date": body.date,
+        "final_key": "Video-" + body.date + ".mp4",
+    }
+
+
 # ====================================================
 # API ENDPOINT — Submit a video job
 # ====================================================
 @app.post("/video-url")
-async def queue_video(
-    audio_url: str = Form(...),
-    image_url: str = Form(...),
-    date: str = Form(...)
-):
+async def queue_video(request: Request, body: VideoJobIn):
     """
     Queue a video creation job.
     
     Args:
-        audio_url: Full URL to the MP3 audio file in R2
-        image_url: Full URL to the image file in R2
-        date: Date string for the filename (e.g., "2025-01-24")
+        body: JSON body with audio_url, image_url and date
     
     Returns:
         JSON response with job details
     """
-    job_id = uuid.uuid4().hex
-    final_key = f"Video-{date}.mp4"
-
-    job = {
-        "job_id": job_id,
-        "audio_url": audio_url,
-        "image_url": image_url,
-        "date": date,
-        "final_key": final_key,
-    }
+    job = build_job(body)
+    job_id, final_key = job["job_id"], job["final_key"]
+
+    # Hand off to the drain loop; Cloudflare is contacted in the background
+    state = request.app.state
+    pending = state.pending
+    if len(pending) >= state.config.max_pending:
+        raise HTTPException(
+            status_code=503,
+            detail="Job queue is full, please retry later"
+        )
+    pending.append(job)
+    if len(pending) == 1 or len(pending) >= state.config.max_batch:
+        state.wake.set()
 
-    # Send to queue
-    enqueue_job(job)
+    return Response(
+        QUEUED_TEMPLATE % (
+            job_id.encode(),
+            orjson.dumps(final_key),
+            orjson.dumps("https://your-r2-bucket.com/" + final_key),
+        ),
+        media_type="application/json",
+    )
 
-    return JSONResponse({
-        "status": "queued",
-        "job_id": job_id,
-        "video_file": final_key,
-        "message": "Job queued successfully. Worker will process it.",
-        "estimated_location": f"https://your-r2-bucket.com/{final_key}"
-    })
+
+@app.post("/video-url/bulk")
+async def queue_video_bulk(
+    request: Request,
+    bodies: Annotated[list[VideoJobIn], Field(min_length=1, max_length=MAX_BULK)],
+):
+    """
+    Queue several video creation jobs with a single Cloudflare call.
+
+    Args:
+        bodies: JSON array of 1 to MAX_BULK jobs, each shaped like /video-url;
+            longer arrays are rejected by validation with a 422
+
+    Returns:
+        JSON array with job_id and video_file for each job, in order
+    """
+    jobs = [build_job(body) for body in bodies]
+
+    # Sent inline rather than via the drain loop so the caller learns the outcome;
+    # transient errors are retried here so a caller retry doesn't mint new job_ids
+    state = request.app.state
+    await enqueue_with_retry(state.cf, state.config, jobs, secrets.token_hex(16))
+
+    return [
+        {"job_id": job["job_id"], "video_file": job["final_key"]}
+        for job in jobs
+    ]
 
 
 @app.get("/")
-def health():
+async def health(request: Request):
     """Health check endpoint."""
-    return {
-        "status": "ok",
-        "service": "video-builder-web",
-        "version": "2.0",
-        "queue": CF_QUEUE_NAME
-    }
+    return Response(request.app.state.health_body, media_type="application/json")
 
 
 @app.get("/health")
-def health_detailed():
+async def health_detailed(request: Request):
     """Detailed health check with configuration."""
+    config = request.app.state.config
     return {
         "status": "ok",
         "service": "video-builder-web",
-        "cloudflare_account": CF_ACCOUNT_ID,
-        "queue_id": CF_QUEUE_ID,
-        "queue_name": CF_QUEUE_NAME,
-        "queue_url": QUEUE_URL,
+        "cloudflare_account": config.account_id,
+        "queue_id": config.queue_id,
+        "queue_name": config.queue_name,
+        "queue_url": config.queue_url,
     }
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", "8000")),
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        loop="uvloop",
+        http="httptools",
+        timeout_keep_alive=75,
+        backlog=2048,
+    )
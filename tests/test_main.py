@@ -0,0 +1,304 @@
+import asyncio
+import gzip
+import os
+import sys
+
+import httpx
+import orjson
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+JOB = {"audio_url": "https://r2.example/a.mp3", "image_url": "https://r2.example/a.png", "date": "2025-01-24"}
+
+
+class FakeCloudflare:
+    """Records every messages/batch POST and answers with scripted statuses."""
+
+    def __init__(self, statuses=()):
+        self.statuses = list(statuses)
+        self.calls = []
+        self.encodings = []
+
+    def __call__(self, request):
+        content = request.content
+        if request.headers.get("content-encoding") == "gzip":
+            content = gzip.decompress(content)
+        messages = orjson.loads(content)["messages"]
+        self.calls.append((request.headers.get("idempotency-key"), [m["body"] for m in messages]))
+        self.encodings.append(request.headers.get("content-encoding"))
+        return httpx.Response(self.statuses.pop(0) if self.statuses else 200)
+
+    @property
+    def sizes(self):
+        return [len(jobs) for _, jobs in self.calls]
+
+
+@pytest.fixture
+def cf(monkeypatch):
+    monkeypatch.setenv("CF_ACCOUNT_ID", "acc")
+    monkeypatch.setenv("CF_QUEUE_ID", "queue")
+    monkeypatch.setenv("CF_API_TOKEN", "token")
+    monkeypatch.setattr(main, "RETRY_BACKOFF", 0.05)
+    fake = FakeCloudflare()
+    monkeypatch.setattr(main.httpx, "AsyncHTTPTransport", lambda **kw: httpx.MockTransport(fake))
+    return fake
+
+
+def run_app(scenario):
+    """Run scenario(client) inside the app lifespan, then shut it down."""
+    async def go():
+        async with main.lifespan(main.app):
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                return await scenario(client)
+    return asyncio.run(go())
+
+
+def test_pending_jobs_are_flushed_on_shutdown(cf, monkeypatch):
+    monkeypatch.setenv("QUEUE_MAX_WAIT_MS", "10000")
+
+    async def scenario(client):
+        for _ in range(2):
+            await client.post("/video-url", json=JOB)
+
+    run_app(scenario)
+    assert cf.sizes == [2]
+
+
+def test_inflight_batch_survives_shutdown_during_backoff(cf, monkeypatch):
+    monkeypatch.setenv("QUEUE_MAX_WAIT_MS", "10")
+    monkeypatch.setattr(main, "RETRY_BACKOFF", 10)
+    cf.statuses = [503]
+
+    async def scenario(client):
+        ids = []
+        for _ in range(4):
+            ids.append((await client.post("/video-url", json=JOB)).json()["job_id"])
+        # Let the first attempt fail; shutdown then lands during the backoff
+        await asyncio.sleep(0.1)
+        return ids
+
+    ids = run_app(scenario)
+    assert cf.sizes == [4, 4]
+    assert cf.calls[0][0] == cf.calls[1][0]
+    assert [job["job_id"] for job in cf.calls[1][1]] == ids
+
+
+def test_drainer_survives_unexpected_errors(cf, monkeypatch):
+    monkeypatch.setenv("QUEUE_MAX_WAIT_MS", "10")
+    calls = []
+
+    def explode_once(request):
+        calls.append(request)
+        if len(calls) == 1:
+            raise RuntimeError("boom")
+        return cf(request)
+
+    monkeypatch.setattr(main.httpx, "AsyncHTTPTransport", lambda **kw: httpx.MockTransport(explode_once))
+
+    async def scenario(client):
+        await client.post("/video-url", json=JOB)
+        await asyncio.sleep(0.1)
+        await client.post("/video-url", json=JOB)
+        await asyncio.sleep(0.1)
+        # Sent by the drainer itself, not by the shutdown flush
+        assert cf.sizes == [1]
+
+    run_app(scenario)
+
+
+def test_full_queue_answers_503(cf, monkeypatch):
+    monkeypatch.setenv("QUEUE_MAX_PENDING", "1")
+    monkeypatch.setenv("QUEUE_MAX_WAIT_MS", "10000")
+
+    async def scenario(client):
+        assert (await client.post("/video-url", json=JOB)).status_code == 200
+        assert (await client.post("/video-url", json=JOB)).status_code == 503
+
+    run_app(scenario)
+
+
+@pytest.mark.parametrize("status", [429, 500, 502, 503, 504])
+def test_transient_errors_are_retried_with_same_key(cf, status):
+    cf.statuses = [status]
+
+    async def scenario(client):
+        await client.post("/video-url", json=JOB)
+        await asyncio.sleep(0.3)
+
+    run_app(scenario)
+    assert cf.sizes == [1, 1]
+    assert cf.calls[0][0] == cf.calls[1][0]
+    assert cf.calls[0][1] == cf.calls[1][1]
+
+
+@pytest.mark.parametrize("status", [400, 401, 403, 404])
+def test_permanent_errors_are_dropped(cf, status):
+    cf.statuses = [status]
+
+    async def scenario(client):
+        await client.post("/video-url", json=JOB)
+        await asyncio.sleep(0.3)
+
+    run_app(scenario)
+    assert cf.sizes == [1]
+
+
+def test_health(cf):
+    async def scenario(client):
+        return await client.get("/")
+
+    resp = run_app(scenario)
+    assert resp.headers["content-type"] == "application/json"
+    assert resp.json() == {
+        "status": "ok",
+        "service": "video-builder-web",
+        "version": "2.0",
+        "queue": "video-jobs",
+    }
+
+
+@pytest.mark.parametrize("flag, encoding", [("1", "gzip"), ("0", None)])
+def test_gzip_request_bodies(cf, monkeypatch, flag, encoding):
+    monkeypatch.setenv("QUEUE_GZIP_REQUESTS", flag)
+
+    async def scenario(client):
+        await client.post("/video-url", json=JOB)
+        await asyncio.sleep(0.2)
+
+    run_app(scenario)
+    assert cf.sizes == [1]
+    assert cf.encodings == [encoding]
+    assert cf.calls[0][1][0]["audio_url"] == JOB["audio_url"]
+
+
+def test_jobs_flush_when_batch_fills(cf, monkeypatch):
+    monkeypatch.setenv("QUEUE_MAX_BATCH", "3")
+    monkeypatch.setenv("QUEUE_MAX_WAIT_MS", "200")
+
+    async def scenario(client):
+        for _ in range(3):
+            assert (await client.post("/video-url", json=JOB)).status_code == 200
+        await asyncio.sleep(0.05)
+        # Full batch wakes the drainer well before max_wait_ms
+        assert cf.sizes == [3]
+
+    run_app(scenario)
+
+
+def test_partial_batch_flushes_after_max_wait(cf, monkeypatch):
+    monkeypatch.setenv("QUEUE_MAX_BATCH", "10")
+    monkeypatch.setenv("QUEUE_MAX_WAIT_MS", "100")
+
+    async def scenario(client):
+        for _ in range(2):
+            await client.post("/video-url", json=JOB)
+        await asyncio.sleep(0.03)
+        assert cf.sizes == []
+        await asyncio.sleep(0.2)
+        assert cf.sizes == [2]
+
+    run_app(scenario)
+
+
+def test_jobs_after_an_overlapping_flush_are_still_batched(cf, monkeypatch):
+    monkeypatch.setenv("QUEUE_MAX_WAIT_MS", "200")
+    slow = asyncio.Event()
+
+    async def slow_cloudflare(request):
+        # Hold the first POST open so a job lands while it is in flight
+        if not cf.calls:
+            await slow.wait()
+        return cf(request)
+
+    monkeypatch.setattr(
+        main.httpx, "AsyncHTTPTransport",
+        lambda **kw: httpx.MockTransport(slow_cloudflare),
+    )
+
+    async def scenario(client):
+        await client.post("/video-url", json=JOB)
+        await asyncio.sleep(0.25)
+        await client.post("/video-url", json=JOB)
+        slow.set()
+        await asyncio.sleep(0.05)
+        assert cf.sizes == [1, 1]
+        # Both of these must share one window, not go out one by one
+        await client.post("/video-url", json=JOB)
+        await asyncio.sleep(0.01)
+        await client.post("/video-url", json=JOB)
+        await asyncio.sleep(0.4)
+        assert cf.sizes == [1, 1, 2]
+
+    run_app(scenario)
+
+
+@pytest.mark.parametrize("count, status", [(0, 422), (1, 200), (main.MAX_BULK, 200), (main.MAX_BULK + 1, 422)])
+def test_bulk_size_cap(cf, count, status):
+    async def scenario(client):
+        return await client.post("/video-url/bulk", json=[JOB] * count)
+
+    resp = run_app(scenario)
+    assert resp.status_code == status
+    assert cf.sizes == ([count] if status == 200 else [])
+
+
+def test_bulk_retries_transient_errors_with_same_jobs(cf):
+    cf.statuses = [503, 502]
+
+    async def scenario(client):
+        return await client.post("/video-url/bulk", json=[JOB] * 3)
+
+    resp = run_app(scenario)
+    assert resp.status_code == 200
+    assert cf.sizes == [3, 3, 3]
+    assert len({key for key, _ in cf.calls}) == 1
+    assert cf.calls[0][1] == cf.calls[2][1]
+    assert [job["job_id"] for job in cf.calls[2][1]] == [job["job_id"] for job in resp.json()]
+
+
+def test_bulk_surfaces_permanent_errors(cf):
+    cf.statuses = [400]
+
+    async def scenario(client):
+        return await client.post("/video-url/bulk", json=[JOB] * 3)
+
+    assert run_app(scenario).status_code == 502
+    assert cf.sizes == [3]
+
+
+@pytest.mark.parametrize("name, value", [
+    ("QUEUE_MAX_BATCH", "0"),
+    ("QUEUE_MAX_BATCH", str(main.MAX_BULK + 1)),
+    ("QUEUE_MAX_WAIT_MS", "0"),
+    ("QUEUE_MAX_PENDING", "0"),
+])
+def test_invalid_batching_config_is_rejected(cf, monkeypatch, name, value):
+    monkeypatch.setenv(name, value)
+    with pytest.raises(RuntimeError, match=name):
+        main.load_config()
+
+
+def test_config_repr_hides_token(cf, monkeypatch):
+    monkeypatch.setenv("CF_API_TOKEN", "s3cr3t-bearer")
+    config = main.load_config()
+    assert config.api_token == "s3cr3t-bearer"
+    assert "s3cr3t-bearer" not in repr(config)
+
+
+@pytest.mark.parametrize("date", ["2025-01-24", "2025-01-24T10:00:00.000+01:00", 'odd "quoted" \\ date'])
+def test_queued_response_is_valid_json(cf, date):
+    async def scenario(client):
+        return await client.post("/video-url", json={**JOB, "date": date})
+
+    resp = run_app(scenario)
+    body = resp.json()
+    assert resp.status_code == 200
+    assert resp.headers["content-type"] == "application/json"
+    assert body["status"] == "queued"
+    assert len(body["job_id"]) == 32
+    assert body["video_file"] == f"Video-{date}.mp4"
+    assert body["estimated_location"] == f"https://your-r2-bucket.com/Video-{date}.mp4"